@@ -4,224 +4,360 @@ Test client for the x402 document summarization service.
 This script demonstrates the full payment flow using x402HttpxClient:
 1. Create a wallet with eth_account
 2. Make a request to the protected endpoint
-3. x402HttpxClient automatically handles 402 response, signs and pays
+3. Sign the payment up front from the 402 quote returned to the unpaid request
+   (x402HttpxClient still handles any 402 response automatically)
 4. Poll for the result
 5. Test payment verification (without payment should fail, reusing payment should fail)
 """
 
 import asyncio
+import logging
 import os
+import random
 import sys
-import time
+import traceback
 
+import aiofiles
 import httpx
-from dotenv import load_dotenv
+import orjson
 from eth_account import Account
+from x402.clients.base import x402Client
 from x402.clients.httpx import x402HttpxClient
+from x402.types import x402PaymentRequiredResponse
 
-# Load environment variables
-load_dotenv()
+# Load environment variables from .env only when the shell has not set them
+if not os.getenv("API_URL") or not os.getenv("PRIVATE_KEY"):
+    from dotenv import load_dotenv
+
+    load_dotenv()
 
 # Configuration
 API_URL = os.getenv("API_URL", "http://localhost:4021")
 PRIVATE_KEY = os.getenv("PRIVATE_KEY")
+MAX_PAYMENT = 10000  # Maximum payment amount in atomic units
+
+# Per-poll chatter goes through the logger (silent unless X402_DEBUG is set)
+logger = logging.getLogger(__name__)
+PROGRESS_EVERY = 10  # Print a progress line every N polls
+
+
+class TestFailure(Exception):
+    """Raised when a step of the payment flow fails; the script exits with status 1"""
+
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Client settings shared by the plain and x402 clients: HTTP/2 where the server
+# supports it, and a small keep-alive pool so the polling connection stays warm
+HTTP_CLIENT_OPTIONS = {
+    "http2": True,
+    "limits": httpx.Limits(max_keepalive_connections=4, max_connections=8, keepalive_expiry=30.0),
+    "timeout": httpx.Timeout(connect=5.0, read=60.0, write=10.0, pool=5.0),
+}
 
 
-async def test_without_payment(document_text: str):
-    """Test that requests without payment are rejected"""
+async def read_document(doc_path: str) -> str:
+    """Read the test document without blocking the event loop"""
+    async with aiofiles.open(doc_path, "rb") as f:
+        doc_bytes = await f.read()
+    return doc_bytes.decode()
+
+
+async def check_health(http: httpx.AsyncClient) -> dict | None:
+    """Check that the service is up, returning its info from GET / (None on failure)"""
+    # Headers are printed together with their results (no await in between) so
+    # the checks running concurrently with this one do not interleave with it
+    try:
+        response = await http.get("/")
+    except Exception as e:
+        print("🔍 Checking if service is running...")
+        print(f"   ❌ Could not connect to service: {e}")
+        print("   Make sure the service is running with 'docker compose up'")
+        return None
+
+    print("🔍 Checking if service is running...")
+    if response.status_code != 200:
+        print(f"   ❌ Service returned status {response.status_code}")
+        print(f"   Response: {response.text}")
+        return None
+
+    print("   ✅ Service is running\n")
+    try:
+        return orjson.loads(response.content)
+    except Exception as e:
+        print(f"   Warning: Could not parse service info: {e}\n")
+        return {}
+
+
+async def test_without_payment(http: httpx.AsyncClient, document_body: bytes) -> dict | None:
+    """Test that requests without payment are rejected, returning the 402 payment quote"""
+    try:
+        response = await http.post(
+            "/summarize-doc",
+            content=document_body,
+            headers=JSON_HEADERS,
+        )
+    except Exception as e:
+        print("🔒 Testing without payment (should fail)...")
+        print(f"   ❌ Error: {e}\n")
+        return None
+
     print("🔒 Testing without payment (should fail)...")
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                f"{API_URL}/summarize-doc",
-                json={"document": document_text},
-            )
-            if response.status_code == 402:
-                print("   ✅ Correctly rejected with 402 Payment Required\n")
-            else:
-                print(f"   ❌ Unexpected status: {response.status_code}\n")
-        except Exception as e:
-            print(f"   ❌ Error: {e}\n")
-
-
-async def test_payment_reuse(document_text: str, payment_header: str):
+    if response.status_code != 402:
+        print(f"   ❌ Unexpected status: {response.status_code}\n")
+        return None
+
+    print("   ✅ Correctly rejected with 402 Payment Required\n")
+    try:
+        return orjson.loads(response.content)
+    except Exception as e:
+        print(f"   Warning: Could not parse the 402 payment quote: {e}\n")
+        return None
+
+
+def sign_payment(account: Account, quote: dict) -> str | None:
+    """
+    Create an X-Payment header for a 402 quote, the same way x402HttpxClient does
+    after a 402 response, so the paid request can carry it on the first attempt.
+
+    Returns None if the quote cannot be paid, leaving payment to x402HttpxClient.
+    """
+    try:
+        payment_required = x402PaymentRequiredResponse(**quote)
+        payer = x402Client(account, max_value=MAX_PAYMENT)
+        requirements = payer.select_payment_requirements(payment_required.accepts)
+        return payer.create_payment_header(requirements, payment_required.x402_version)
+    except Exception as e:
+        print(f"   Warning: Could not pre-sign payment: {e}")
+        return None
+
+
+async def test_payment_reuse(http: httpx.AsyncClient, document_body: bytes, payment_header: str):
     """Test that reusing the same payment is rejected"""
+    try:
+        # Only the status code matters here, so stream the response and leave
+        # the error body unread unless the status is unexpected
+        async with http.stream(
+            "POST",
+            "/summarize-doc",
+            content=document_body,
+            headers={**JSON_HEADERS, "X-Payment": payment_header},
+        ) as response:
+            if response.status_code not in (400, 402):
+                await response.aread()
+    except Exception as e:
+        print("🔒 Testing payment reuse (should fail)...")
+        print(f"   ❌ Error: {e}\n")
+        return
+
+    # Printed in one go since this runs alongside the poll loop's output
     print("🔒 Testing payment reuse (should fail)...")
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                f"{API_URL}/summarize-doc",
-                json={"document": document_text},
-                headers={"X-Payment": payment_header},
-            )
-            if response.status_code == 402:
-                print("   ✅ Correctly rejected payment reuse with 402\n")
-            elif response.status_code == 400:
-                print("   ✅ Correctly rejected payment reuse with 400\n")
-            else:
-                print(f"   ❌ Unexpected status: {response.status_code}\n")
-                print(f"   Response: {response.text}\n")
-        except Exception as e:
-            print(f"   ❌ Error: {e}\n")
-
-
-async def test_summarize_document(document_text: str):
+    if response.status_code == 402:
+        print("   ✅ Correctly rejected payment reuse with 402\n")
+    elif response.status_code == 400:
+        print("   ✅ Correctly rejected payment reuse with 400\n")
+    else:
+        print(f"   ❌ Unexpected status: {response.status_code}\n")
+        print(f"   Response: {response.text}\n")
+
+
+async def test_summarize_document(doc_path: str):
     """
     Test the document summarization endpoint with automatic payment handling.
 
     Args:
-        document_text: The document to summarize
+        doc_path: Path to the document to summarize
     """
     print("🚀 Starting x402 payment flow test...\n")
+    loop = asyncio.get_running_loop()  # Monotonic clock for elapsed times
 
     # Check for private key
     if not PRIVATE_KEY:
         print("❌ Error: PRIVATE_KEY environment variable not set")
         print("   Generate a key with: from eth_account import Account; Account.create()")
-        sys.exit(1)
-
-    # Check if service is running
-    print("🔍 Checking if service is running...")
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f"{API_URL}/")
-            if response.status_code == 200:
-                print("   ✅ Service is running\n")
-            else:
-                print(f"   ❌ Service returned status {response.status_code}")
-                print(f"   Response: {response.text}")
-                sys.exit(1)
-        except Exception as e:
-            print(f"   ❌ Could not connect to service: {e}")
-            print("   Make sure the service is running with 'docker compose up'")
-            sys.exit(1)
-
-    # Create account from private key
-    print("💼 Setting up wallet...")
-    account = Account.from_key(PRIVATE_KEY)
-    print(f"   Wallet address: {account.address}\n")
-
-    # Test without payment first
-    await test_without_payment(document_text)
-
-    # Create x402-enabled HTTP client
-    print("📡 Creating x402 HTTP client...")
-    async with x402HttpxClient(
-        account, max_value=10000, timeout=60.0
-    ) as client:
-        print(f"   Client ready with automatic payment handling\n")
-
-        # Make request - payment will be handled automatically
-        print(f"📝 Requesting document summary from {API_URL}/summarize-doc...")
-        print(f"   Document length: {len(document_text)} characters")
-        print(f"   (Payment will be handled automatically if required)\n")
-
-        try:
-            start_time = time.time()
-            response = await client.post(
-                f"{API_URL}/summarize-doc",
-                json={"document": document_text},
-            )
-            elapsed = time.time() - start_time
-
-            if response.status_code == 200:
-                try:
-                    result = response.json()
-                except Exception as e:
-                    print(f"❌ Error parsing JSON response: {e}")
-                    print(f"Response text: {response.text}")
-                    sys.exit(1)
-                    
-                print(f"✅ Job created (took {elapsed:.2f}s)")
-                print(f"   Job ID: {result['job_id']}")
-                print(f"   Status: {result['status']}")
-                print(f"   Status URL: {result['status_url']}")
-                
-                # Display AI provider information if available
-                if "provider" in result:
-                    print(f"   AI Provider: {result['provider']}")
-                print()
-
-                # Test payment reuse with the same payment header
-                payment_header = response.request.headers.get("X-Payment")
-                if payment_header:
-                    await test_payment_reuse(document_text, payment_header)
-
-                # Poll for result
-                job_id = result["job_id"]
-                print(f"⏳ Polling for result...")
-
-                max_polls = 150  # Poll for up to 10 minutes (150 * 4 seconds)
-                poll_interval = 4  # seconds
-
-                for i in range(max_polls):
-                    await asyncio.sleep(poll_interval)
-
-                    status_response = await client.get(f"{API_URL}/summarize-doc/{job_id}")
-                    
-                    # Check if the response is valid
-                    if status_response.status_code != 200:
-                        print(f"   ❌ Error polling for result: {status_response.status_code}")
-                        print(f"   Response: {status_response.text}")
-                        sys.exit(1)
-                        
+        raise TestFailure("PRIVATE_KEY not set")
+
+    # One plain client is shared by the health check and the negative payment
+    # tests so they reuse a single connection pool
+    async with httpx.AsyncClient(base_url=API_URL, **HTTP_CLIENT_OPTIONS) as http:
+        async def load_and_test_without_payment() -> tuple[str, bytes, dict | None]:
+            document_text = await read_document(doc_path)
+            # Encode the request body once; every summarize-doc POST reuses it
+            document_body = orjson.dumps({"document": document_text})
+            quote = await test_without_payment(http, document_body)
+            return document_text, document_body, quote
+
+        # The health check, loading the document (plus the no-payment test that
+        # needs it) and the wallet key derivation are independent, so run them
+        # concurrently
+        root_data, (document_text, document_body, quote), account = await asyncio.gather(
+            check_health(http),
+            load_and_test_without_payment(),
+            asyncio.to_thread(Account.from_key, PRIVATE_KEY),
+        )
+        if root_data is None:
+            raise TestFailure("Service is not running")
+        print("💼 Setting up wallet...")
+        print(f"   Wallet address: {account.address}\n")
+
+        # Sign against the quote from the unpaid request so the paid request
+        # does not need a 402 round trip first
+        paid_headers = JSON_HEADERS
+        if quote is not None:
+            presigned_header = await asyncio.to_thread(sign_payment, account, quote)
+            if presigned_header:
+                paid_headers = {**JSON_HEADERS, "X-Payment": presigned_header}
+
+        # Create x402-enabled HTTP client
+        print("📡 Creating x402 HTTP client...")
+        async with x402HttpxClient(
+            account, max_value=MAX_PAYMENT, **HTTP_CLIENT_OPTIONS
+        ) as client:
+            print(f"   Client ready with automatic payment handling\n")
+
+            # Make request - payment will be handled automatically
+            print(f"📝 Requesting document summary from {API_URL}/summarize-doc...")
+            print(f"   Document length: {len(document_text)} characters")
+            print(f"   (Payment will be handled automatically if required)\n")
+
+            try:
+                start_time = loop.time()
+                response = await client.post(
+                    f"{API_URL}/summarize-doc",
+                    content=document_body,
+                    headers=paid_headers,
+                )
+                elapsed = loop.time() - start_time
+
+                if response.status_code == 200:
                     try:
-                        status_data = status_response.json()
+                        result = orjson.loads(response.content)
                     except Exception as e:
-                        print(f"   ❌ Error parsing JSON response: {e}")
-                        print(f"   Response text: {status_response.text}")
-                        sys.exit(1)
-
-                    if status_data["status"] == "completed":
-                        print(f"   ✅ Completed after ~{(i+1) * poll_interval}s\n")
-                        print(f"📄 Summary:")
-                        print(f"   {status_data['summary']}\n")
-                        print(f"📊 Stats:")
-                        print(f"   Word count: {status_data['word_count']}")
-                        print(f"   Reading time: {status_data['reading_time']}")
-                        
-                        # Display AI provider information in results
-                        try:
-                            root_response = await client.get(f"{API_URL}/")
-                            if root_response.status_code == 200:
-                                root_data = root_response.json()
-                                if "ai_provider" in root_data:
+                        print(f"❌ Error parsing JSON response: {e}")
+                        print(f"Response text: {response.text}")
+                        raise TestFailure("Invalid job creation response")
+
+                    # Issue the first status poll immediately, before any output,
+                    # since the job may already be finished by the time we look
+                    job_id = result["job_id"]
+                    first_poll = asyncio.create_task(client.get(f"{API_URL}/summarize-doc/{job_id}"))
+                    poll_start = loop.time()
+
+                    print(f"✅ Job created (took {elapsed:.2f}s)")
+                    print(f"   Job ID: {result['job_id']}")
+                    print(f"   Status: {result['status']}")
+                    print(f"   Status URL: {result['status_url']}")
+
+                    # Display AI provider information if available
+                    if "provider" in result:
+                        print(f"   AI Provider: {result['provider']}")
+                    print()
+
+                    # Test payment reuse with the same payment header, in the background
+                    # since it does not depend on the job result
+                    reuse_task = None
+                    payment_header = response.request.headers.get("X-Payment")
+                    if payment_header:
+                        reuse_task = asyncio.create_task(
+                            test_payment_reuse(http, document_body, payment_header)
+                        )
+
+                    # Poll for result
+                    try:
+                        print(f"⏳ Polling for result...")
+
+                        max_wait = 600  # Poll for up to 10 minutes
+                        i = 0
+
+                        while loop.time() - poll_start < max_wait:
+                            if i == 0:
+                                status_response = await first_poll
+                            else:
+                                # Exponential backoff with jitter: poll tightly at first since
+                                # short documents finish fast, then taper off to 8s
+                                delay = min(0.5 * (2 ** min(i - 1, 5)), 8.0)
+                                delay *= 0.5 + random.random()
+                                await asyncio.sleep(delay)
+                                status_response = await client.get(f"{API_URL}/summarize-doc/{job_id}")
+                            i += 1
+
+                            # Check if the response is valid
+                            if status_response.status_code != 200:
+                                print(f"   ❌ Error polling for result: {status_response.status_code}")
+                                print(f"   Response: {status_response.text}")
+                                raise TestFailure(f"Polling failed with status {status_response.status_code}")
+
+                            # Only decode the body when it may hold a terminal status (or
+                            # when debug output needs it); "processing" bodies are skipped
+                            body = status_response.content
+                            if b'"completed"' in body or b'"failed"' in body or logger.isEnabledFor(logging.DEBUG):
+                                try:
+                                    status_data = orjson.loads(body)
+                                except Exception as e:
+                                    print(f"   ❌ Error parsing JSON response: {e}")
+                                    print(f"   Response text: {status_response.text}")
+                                    raise TestFailure("Invalid job status response")
+                                status = status_data.get("status", "Unknown")
+                            else:
+                                status_data = None
+                                status = "processing"
+
+                            if status == "completed":
+                                print(f"   ✅ Completed after {loop.time() - poll_start:.1f}s\n")
+                                print(f"📄 Summary:")
+                                print(f"   {status_data['summary']}\n")
+                                print(f"📊 Stats:")
+                                print(f"   Word count: {status_data['word_count']}")
+                                print(f"   Reading time: {status_data['reading_time']}")
+
+                                # Display AI provider information from the health check
+                                if root_data.get("ai_provider"):
                                     print(f"   AI Provider: {root_data['ai_provider']}")
-                        except Exception as e:
-                            print(f"   Warning: Could not fetch AI provider info: {e}")
-                        print()
-                        
-                        return status_data
-                    elif status_data["status"] == "failed":
-                        print(f"   ❌ Job failed: {status_data.get('error', 'Unknown error')}")
-                        if "error_details" in status_data:
-                            print(f"   Error details: {status_data['error_details']}")
-                        print(f"   Full response: {status_data}")
-                        sys.exit(1)
-                    else:
-                        print(f"   Still processing... ({i+1}/{max_polls})")
-                        print(f"   Current status: {status_data.get('status', 'Unknown')}")
-                        print(f"   Full response: {status_data}")
-
-                print(f"   ❌ Timeout waiting for result after {(max_polls * poll_interval) // 60} minutes")
-                sys.exit(1)
-
-            else:
-                print(f"❌ Request failed with status {response.status_code} (after {elapsed:.2f}s)")
-                print(f"   Response headers: {response.headers}")
-                print(f"   Response text: {response.text}")
-                sys.exit(1)
-
-        except Exception as e:
-            elapsed = time.time() - start_time if 'start_time' in locals() else 0
-            print(f"❌ Error after {elapsed:.2f}s: {e}")
-            import traceback
-
-            traceback.print_exc()
-            sys.exit(1)
+                                print()
+                                return status_data
+                            elif status == "failed":
+                                print(f"   ❌ Job failed: {status_data.get('error', 'Unknown error')}")
+                                if "error_details" in status_data:
+                                    print(f"   Error details: {status_data['error_details']}")
+                                print(f"   Full response: {status_data}")
+                                raise TestFailure("Job failed")
+                            else:
+                                if i % PROGRESS_EVERY == 0:
+                                    print(f"   Still processing... (poll {i}, {loop.time() - poll_start:.0f}s elapsed)")
+                                else:
+                                    logger.debug("Still processing... (poll %d, %.0fs elapsed)", i, loop.time() - poll_start)
+                                logger.debug("Current status: %s", status)
+                                logger.debug("Full response: %s", status_data)
+
+                        print(f"   ❌ Timeout waiting for result after {max_wait // 60} minutes")
+                        raise TestFailure("Timed out waiting for result")
+                    finally:
+                        # Never leave the reuse test running once the clients start closing
+                        if reuse_task:
+                            await reuse_task
+
+                else:
+                    print(f"❌ Request failed with status {response.status_code} (after {elapsed:.2f}s)")
+                    print(f"   Response headers: {response.headers}")
+                    print(f"   Response text: {response.text}")
+                    raise TestFailure(f"Request failed with status {response.status_code}")
+
+            except TestFailure:
+                raise
+            except Exception as e:
+                elapsed = loop.time() - start_time if 'start_time' in locals() else 0
+                print(f"❌ Error after {elapsed:.2f}s: {e}")
+                traceback.print_exc()
+                raise TestFailure(str(e)) from e
 
 
 if __name__ == "__main__":
+    # Only the script's own logger honours X402_DEBUG, so httpx/httpcore/h2
+    # debug output stays off
+    logging.basicConfig(level=logging.WARNING, format="   %(message)s")
+    if os.getenv("X402_DEBUG"):
+        logger.setLevel(logging.DEBUG)
+
     # Load test document from file
     script_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -231,7 +367,21 @@ if __name__ == "__main__":
     else:
         doc_path = os.path.join(script_dir, "test_document.txt")
 
-    with open(doc_path, "r") as f:
-        test_doc = f.read()
-
-    asyncio.run(test_summarize_document(test_doc))
\ No newline at end of file
+    # Use uvloop when it is installed (the script is all event-loop driven I/O)
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+
+    try:
+        if uvloop is None:
+            asyncio.run(test_summarize_document(doc_path))
+        elif sys.version_info >= (3, 11):
+            with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+                runner.run(test_summarize_document(doc_path))
+        else:
+            uvloop.install()
+            asyncio.run(test_summarize_document(doc_path))
+    except TestFailure:
+        # The failing step has already reported the details
+        sys.exit(1)
\ No newline at end of file